@@ -3,8 +3,9 @@
 # and comparing them to the total licenses allocated. It then sends a summary
 # alert to a configured Slack channel via an Incoming Webhook.
 #
-# The script uses Adobe's User Management API to fetch user data and calculate
-# license usage. Total licenses are mapped manually in the script.
+# The script uses Adobe's User Management API to fetch the number of users
+# assigned to each product profile and calculate license usage. Total licenses
+# are mapped manually in the script.
 #
 # Required Environment Variables:
 #   ADOBE_ACCESS_TOKEN       - Bearer token for Adobe API access.
@@ -12,135 +13,255 @@
 #   ADOBE_ORG_ID             - Organization ID for Adobe API access.
 #   SLACK_WEBHOOK_URL  - Webhook URL to send Slack alerts.
 #
+# Required Packages:
+#   requests, orjson, urllib3 >= 2.0 (for Retry backoff_jitter)
+#
 # Author: Chad Ramey
 # Last Updated: January 2, 2025
 
-import json
+import orjson
+import re
 import requests
-from time import sleep
-from random import randint
 import os
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_access_token():
-    """Retrieve the Adobe access token from environment variables."""
-    return os.getenv('ADOBE_ACCESS_TOKEN')
-
-def get_users_in_org():
-    """Retrieve all users in the organization with pagination."""
-    page_index = 0
-    url = f"https://usermanagement.adobe.io/v2/usermanagement/users/{os.getenv('ADOBE_ORG_ID')}/{page_index}"
-    method = 'GET'
-    done = False
-    users_list = []
-
-    while not done:
-        r = make_call(method, url)
-        if r:
-            users_list.extend(r['users'])
-            if r['lastPage']:
-                done = True
-            else:
-                page_index += 1
-                url = f"https://usermanagement.adobe.io/v2/usermanagement/users/{os.getenv('ADOBE_ORG_ID')}/{page_index}"
-        else:
-            print("Failed to retrieve user data.")
-            break
-
-    return users_list
-
-def make_call(method, url, body=None):
-    """Make an API call with retries."""
-    retry_wait = 0
-    headers = {
-        'Accept': 'application/json',
-        'x-api-key': os.getenv('ADOBE_CLIENT_ID'),
-        'Authorization': f"Bearer {get_access_token()}"
-    }
-    if body:
-        headers['Content-type'] = 'application/json'
-        body = json.dumps(body)
-
-    for attempt in range(1, 5):  # Maximum retries: 4
-        try:
-            print(f'Calling {method} {url}')
-            response = requests.request(method, url, data=body, headers=headers, timeout=120)
-
-            if response.status_code == 200:
-                return response.json()
-            elif response.status_code in [429, 502, 503, 504]:
-                print(f'Rate limited or timeout (code {response.status_code}) on attempt {attempt}')
-                retry_wait = int(response.headers.get('Retry-After', (2 ** attempt) + randint(0, 5)))
-            else:
-                print(f"Unexpected HTTP Status: {response.status_code} - {response.text}")
-                return None
-
-        except Exception as e:
-            print(f"Exception during API call: {e}")
-            return None
-
-        if attempt < 4:
-            print(f"Retrying in {retry_wait} seconds...")
-            sleep(retry_wait)
-
-    print("Maximum retries reached. Exiting.")
-    return None
-
-def summarize_licenses(users):
-    """Summarize licenses associated with users."""
-    license_counts = {}
-
-    # Mapping of cleaned license names to their total counts
-    license_mapping = {
-        "Acrobat Pro": 316,
-        "All Apps plan": 268,
-        "Photoshop": 14,
-        "Audition": 2,
-        "Premiere Pro": 22,
-        "Illustrator": 7,
-        "Lightroom": 1,
-        "Substance": 4
-    }
-
-    for user in users:
-        for group in user.get('groups', []):
-            # Clean up license name
-            cleaned_group = (
-                group.replace("Default ", "")
-                .replace("configuration", "")
-                .replace(" plan with 1TB", "")
-                .replace(" - 100 GB", "")
-                .replace(" - 1024 GB", "")
-                .replace("Single App", "")
-                .replace(" DC", "")
-                .replace(" 3D Collection Configuration", "")
-                .strip()
+# Environment configuration, read once at startup
+ADOBE_ACCESS_TOKEN = os.getenv('ADOBE_ACCESS_TOKEN')
+ADOBE_CLIENT_ID = os.getenv('ADOBE_CLIENT_ID')
+ADOBE_ORG_ID = os.getenv('ADOBE_ORG_ID')
+SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL')
+
+# Adobe API headers, constant for the whole run. Passed per call rather than
+# set on SESSION so they are never sent to the Slack webhook.
+AUTH_HEADER = {
+    'Accept': 'application/json',
+    'x-api-key': ADOBE_CLIENT_ID,
+    'Authorization': f"Bearer {ADOBE_ACCESS_TOKEN}"
+}
+
+# Groups endpoint for the org; the page index is appended per request. Each
+# group carries its memberCount, so per-user records are never downloaded.
+GROUPS_URL = f"https://usermanagement.adobe.io/v2/usermanagement/groups/{ADOBE_ORG_ID}/"
+
+# Group pages from the previous run with their ETag/Last-Modified validators,
+# so unchanged pages can be answered with a 304
+PAGE_CACHE_PATH = os.path.expanduser('~/.cache/adobe_license_monitor/group_pages.json')
+
+# Maximum number of group pages fetched concurrently
+MAX_WORKERS = 4
+
+# Fragments stripped from group names to get the license name
+LICENSE_CLEANUP_RE = re.compile(
+    r"Default |configuration| plan with 1TB| - 100 GB| - 1024 GB|Single App| DC| 3D Collection Configuration"
+)
+
+# Retries for rate limiting, gateway and connection errors (GETs only)
+RETRY = Retry(
+    total=4,
+    status_forcelist=[429, 502, 503, 504],
+    respect_retry_after_header=True,
+    backoff_factor=1,
+    backoff_jitter=1.0,
+    raise_on_status=False
+)
+
+# Mapping of cleaned license names to their total counts
+LICENSE_MAPPING = {
+    "Acrobat Pro": 316,
+    "All Apps plan": 268,
+    "Photoshop": 14,
+    "Audition": 2,
+    "Premiere Pro": 22,
+    "Illustrator": 7,
+    "Lightroom": 1,
+    "Substance": 4
+}
+
+# Summary unit for licenses not counted in seats (defaults to "License")
+LICENSE_UNITS = {
+    "Adobe Stock Credits": "Credit"
+}
+
+# Shared session so Adobe and Slack calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=RETRY
+))
+
+def is_valid_page_entry(entry):
+    """Check that a page cache entry has the shape get_groups_page writes."""
+    try:
+        return (
+            isinstance(entry['etag'], (str, type(None)))
+            and isinstance(entry['last_modified'], (str, type(None)))
+            and isinstance(entry['page']['lastPage'], bool)
+            and all(
+                isinstance(group['groupName'], str)
+                and isinstance(group['memberCount'], int)
+                and 'type' in group
+                for group in entry['page']['groups']
             )
-            license_counts[cleaned_group] = license_counts.get(cleaned_group, 0) + 1
+        )
+    except (KeyError, TypeError):
+        return False
+
+def load_page_cache():
+    """Return the group pages cached by the previous run, keyed by page index."""
+    try:
+        with open(PAGE_CACHE_PATH, 'rb') as f:
+            cached = orjson.loads(f.read())
+        pages = cached['pages']
+        # A cache for another org, or one that is truncated or hand-edited,
+        # is thrown away as a whole
+        if cached['org_id'] == ADOBE_ORG_ID and all(
+                key.isdigit() and is_valid_page_entry(entry) for key, entry in pages.items()):
+            return pages
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return {}
+
+def save_page_cache(pages):
+    """Persist cached group pages for the next run."""
+    try:
+        os.makedirs(os.path.dirname(PAGE_CACHE_PATH), mode=0o700, exist_ok=True)
+        with open(PAGE_CACHE_PATH, 'wb') as f:
+            f.write(orjson.dumps({'org_id': ADOBE_ORG_ID, 'pages': pages}))
+    except OSError as e:
+        print(f"Could not cache group pages: {e}")
+
+def count_licenses_in_org(license_counts):
+    """Count licenses across all group pages of the organization into license_counts."""
+    page_cache = load_page_cache()
+
+    r, _, error = get_groups_page(0, AUTH_HEADER, page_cache)
+    if r is None:
+        print(error)
+        return
+    count_group_licenses(license_counts, r['groups'])
+    done = r['lastPage']
+    last_page = 0
+
+    # Keep a sliding window of in-flight page requests so a slow page never
+    # stalls the pages behind it. The window grows by one page per page
+    # consumed, so at most MAX_WORKERS - 1 requests go past the last page.
+    pending = deque()
+    next_page = 1
+    window = 1
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            while not done:
+                while len(pending) < window:
+                    pending.append(executor.submit(get_groups_page, next_page, AUTH_HEADER, page_cache))
+                    next_page += 1
+                r, _, error = pending.popleft().result()
+                if r is None:
+                    print(error)
+                    break
+                last_page += 1
+                count_group_licenses(license_counts, r['groups'])
+                done = r['lastPage']
+                window = min(window + 1, MAX_WORKERS)
+        finally:
+            # Drop speculative requests for pages past the last one
+            for future in pending:
+                future.cancel()
+
+    # Only a complete walk is cached, without any pages past the last one
+    if done:
+        save_page_cache({key: page for key, page in page_cache.items() if int(key) <= last_page})
+
+def get_groups_page(page_index, headers, page_cache):
+    """Retrieve a page of groups, revalidating any cached copy with the server.
+
+    Returns (page, status_code, error); page is None on failure and
+    status_code is None when no response was received.
+    """
+    key = str(page_index)
+    cached = page_cache.get(key)
+    if cached:
+        headers = dict(headers)
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    try:
+        response = SESSION.get(GROUPS_URL + key, headers=headers, timeout=120)
+    except requests.exceptions.RequestException as e:
+        return None, None, f"Exception during API call: {e}"
+
+    if response.status_code == 304 and cached:
+        return cached['page'], response.status_code, None
+
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            page_cache[key] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'page': {
+                    'lastPage': data['lastPage'],
+                    'groups': [
+                        {
+                            'groupName': group['groupName'],
+                            'type': group.get('type'),
+                            'memberCount': group.get('memberCount', 0)
+                        }
+                        for group in data['groups']
+                    ]
+                }
+            }
+        else:
+            page_cache.pop(key, None)
+        return data, response.status_code, None
+
+    return None, response.status_code, f"Failed to retrieve group data: {response.status_code} - {response.text}"
+
+@lru_cache(maxsize=256)
+def clean_license_name(group: str) -> str:
+    """Strip configuration/storage fragments from a group name."""
+    return LICENSE_CLEANUP_RE.sub("", group).strip()
 
-    summary = []
-    for license_name, used in license_counts.items():
-        total = license_mapping.get(license_name, "Unknown")
-        unit = "License" if license_name != "Adobe Stock Credits" else "Credits"
-        unit += "s" if used > 1 else ""
-        summary.append(f"{license_name}: {used} of {total} {unit}")
+def count_group_licenses(license_counts: Counter, groups: list[dict]) -> None:
+    """Add the member count of each product profile in groups to license_counts."""
+    for group in groups:
+        if group.get('type') == 'PRODUCT_PROFILE' and group.get('memberCount'):
+            license_counts[clean_license_name(group['groupName'])] += group['memberCount']
 
-    return "\n".join(summary)
+def summarize_licenses(license_counts: Counter) -> str:
+    """Summarize license usage from the collected counts."""
+    return "\n".join(
+        f"{license_name}: {used} of {LICENSE_MAPPING.get(license_name, 'Unknown')} "
+        f"{LICENSE_UNITS.get(license_name, 'License')}{'s' if used > 1 else ''}"
+        for license_name, used in license_counts.items()
+    )
 
 def send_slack_alert(message):
     """Send the license summary to Slack."""
-    webhook_url = os.getenv('SLACK_WEBHOOK_URL')
     payload = {"text": message}
-    response = requests.post(webhook_url, json=payload)
+    response = SESSION.post(SLACK_WEBHOOK_URL, json=payload)
     if response.status_code == 200:
         print("Slack alert sent!")
     else:
         print(f"Failed to send Slack alert: {response.status_code} - {response.text}")
 
 if __name__ == '__main__':
-    users = get_users_in_org()
-    if users:
-        summary = summarize_licenses(users)
-        print("License Summary:\n" + summary)
-        send_slack_alert(f":adobe: *Adobe License Report* :adobe:\n{summary}")
+    license_counts = Counter()
+    count_licenses_in_org(license_counts)
+    if license_counts:
+        summary = summarize_licenses(license_counts)
+        # Post to Slack in the background while the summary is logged locally
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            slack_alert = executor.submit(send_slack_alert, f":adobe: *Adobe License Report* :adobe:\n{summary}")
+            print("License Summary:\n" + summary)
+            slack_alert.result()
     else:
-        print("No user data retrieved.")
+        print("No license data retrieved.")
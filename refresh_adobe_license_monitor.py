@@ -1,26 +1,76 @@
-import json
+# Required Packages: requests, orjson, urllib3 >= 2.0 (for Retry backoff_jitter)
+
+import orjson
+import re
 import requests
 import os
-from authlib.integrations.requests_client import OAuth2Session
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Adobe API endpoints
 TOKEN_URL = "https://ims-na1.adobelogin.com/ims/token/v3"
-USER_API_BASE_URL = "https://usermanagement.adobe.io/v2/usermanagement/users"
-
-# Excluded groups
-EXCLUDED_GROUPS = [
-    "Default Acrobat Pro DC configuration_B90DF18-provisioning",
-    "Default All Apps plan - 100 GB configuration_C9431CF-provisioning",
-    "Default Photoshop - 100 GB configuration_0A61F1F-provisioning",
-    "Default Audition - 1024 GB configuration_4A18C28-provisioning",
-    "_product_admin_Custom fonts (VIP,VIPMP - A1406BFDEA1D8CDBEDEA)",
-    "_admin_Default Custom fonts configuration",
-    "Default Premiere Pro - 1024 GB configuration_E71BE78-provisioning",
-    "Default Illustrator - 100 GB configuration_A69B937-provisioning",
-    "Default Lightroom Single App plan with 1TB configuration_6FBBDC1-provisioning",
-    "Acrobat Users",
-    "Default Custom fonts configuration"
-]
+GROUP_API_BASE_URL = "https://usermanagement.adobe.io/v2/usermanagement/groups"
+
+# Environment configuration, read once at startup
+ADOBE_CLIENT_ID = os.getenv('ADOBE_CLIENT_ID')
+ADOBE_CLIENT_SECRET = os.getenv('ADOBE_CLIENT_SECRET')
+ADOBE_ORG_ID = os.getenv('ADOBE_ORG_ID')
+SLACK_WEBHOOK_URL = os.getenv('SLACK_WEBHOOK_URL')
+
+# Access tokens are cached between runs and refreshed this many seconds
+# before they expire
+TOKEN_CACHE_PATH = os.path.expanduser('~/.cache/adobe_license_monitor/token.json')
+TOKEN_EXPIRY_MARGIN = 300
+
+# Group pages from the previous run with their ETag/Last-Modified validators,
+# so unchanged pages can be answered with a 304
+PAGE_CACHE_PATH = os.path.expanduser('~/.cache/adobe_license_monitor/refresh_group_pages.json')
+
+# Groups endpoint for the org; the page index is appended per request. Each
+# group carries its memberCount, so per-user records are never downloaded.
+GROUPS_URL = f"{GROUP_API_BASE_URL}/{ADOBE_ORG_ID}/"
+
+# Maximum number of group pages fetched concurrently
+MAX_WORKERS = 4
+
+# Fragments stripped from group names to get the license name
+LICENSE_CLEANUP_RE = re.compile(
+    r"Default |configuration| plan with 1TB| - 100 GB| - 1024 GB|Single App| DC| 3D Collection Configuration"
+)
+
+# Retry 429/5xx and connection errors on idempotent requests
+RETRY = Retry(
+    total=4,
+    status_forcelist=[429, 502, 503, 504],
+    respect_retry_after_header=True,
+    backoff_factor=1,
+    backoff_jitter=1.0,
+    raise_on_status=False
+)
+
+# Shared session so Adobe and Slack calls reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=RETRY
+))
+
+# Requesting a token twice is harmless, so the IMS token POST is retried too
+SESSION.mount(TOKEN_URL, HTTPAdapter(
+    max_retries=RETRY.new(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'})
+))
+
+# Groups that do not represent a license: per-product provisioning groups
+# (suffixed "_<id>-provisioning"), admin roles and plain user groups
+LICENSE_EXCLUDE_RE = re.compile(
+    r"-provisioning$|^_admin_|^_product_admin_|^Acrobat Users$|^Default Custom fonts configuration$"
+)
 
 # License mappings
 LICENSE_MAPPING = {
@@ -34,108 +84,280 @@ LICENSE_MAPPING = {
     "Substance": 4
 }
 
+# Summary unit for licenses not counted in seats (defaults to "License")
+LICENSE_UNITS = {
+    "Adobe Stock Credits": "Credit"
+}
+
+def load_cached_token():
+    """Return the cached access token if it is still valid, else None."""
+    try:
+        with open(TOKEN_CACHE_PATH, 'rb') as f:
+            cached = orjson.loads(f.read())
+        if (cached['client_id'] == ADOBE_CLIENT_ID
+                and time.time() < cached['expires_at'] - TOKEN_EXPIRY_MARGIN):
+            return cached['access_token']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_cached_token(access_token, expires_at):
+    """Persist the access token and its expiry, readable only by the owner."""
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_PATH), mode=0o700, exist_ok=True)
+        fd = os.open(TOKEN_CACHE_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(orjson.dumps({
+                'client_id': ADOBE_CLIENT_ID,
+                'access_token': access_token,
+                'expires_at': expires_at
+            }))
+    except OSError as e:
+        print(f"Could not cache access token: {e}")
+
+def clear_cached_token():
+    """Remove the cached access token, if any."""
+    try:
+        os.remove(TOKEN_CACHE_PATH)
+    except OSError:
+        pass
+
 def get_access_token():
-    """Retrieve or generate a new Adobe access token using client credentials."""
+    """Return a cached or newly generated access token as (access_token, from_cache)."""
+    cached_token = load_cached_token()
+    if cached_token:
+        print("Using cached access token.")
+        return cached_token, True
+
     print("Access token expired or missing. Generating a new one...")
+    return fetch_access_token(), False
 
-    client_id = os.getenv('ADOBE_CLIENT_ID')
-    client_secret = os.getenv('ADOBE_CLIENT_SECRET')
+def fetch_access_token():
+    """Generate a new Adobe access token and cache it for later runs."""
+    try:
+        response = SESSION.post(TOKEN_URL, data={
+            'grant_type': 'client_credentials',
+            'client_id': ADOBE_CLIENT_ID,
+            'client_secret': ADOBE_CLIENT_SECRET,
+            'scope': 'openid,AdobeID,user_management_sdk'
+        }, timeout=30)
+    except requests.exceptions.RequestException as e:
+        print(f"Exception during token request: {e}")
+        return None
 
-    session = OAuth2Session(client_id, client_secret)
-    token = session.fetch_token(
-        TOKEN_URL,
-        grant_type='client_credentials',
-        scope='openid,AdobeID,user_management_sdk'
-    )
+    if response.status_code != 200:
+        print(f"Failed to generate access token: {response.status_code} - {response.text}")
+        return None
 
+    token = orjson.loads(response.content)
     new_access_token = token.get('access_token')
+    if new_access_token:
+        save_cached_token(new_access_token, time.time() + token.get('expires_in', 0))
     print("Access token generated successfully.")
     return new_access_token
 
-def get_users_in_org(access_token):
-    """Retrieve all users in the Adobe organization with pagination."""
-    page_index = 0
-    url = f"{USER_API_BASE_URL}/{os.getenv('ADOBE_ORG_ID')}/{page_index}"
-    users_list = []
+def is_valid_page_entry(entry):
+    """Check that a page cache entry has the shape get_groups_page writes."""
+    try:
+        return (
+            isinstance(entry['etag'], (str, type(None)))
+            and isinstance(entry['last_modified'], (str, type(None)))
+            and isinstance(entry['page']['lastPage'], bool)
+            and all(
+                isinstance(group['groupName'], str)
+                and isinstance(group['memberCount'], int)
+                and 'type' in group
+                for group in entry['page']['groups']
+            )
+        )
+    except (KeyError, TypeError):
+        return False
+
+def load_page_cache():
+    """Return the group pages cached by the previous run, keyed by page index."""
+    try:
+        with open(PAGE_CACHE_PATH, 'rb') as f:
+            cached = orjson.loads(f.read())
+        pages = cached['pages']
+        # A cache for another org, or one that is truncated or hand-edited,
+        # is thrown away as a whole
+        if cached['org_id'] == ADOBE_ORG_ID and all(
+                key.isdigit() and is_valid_page_entry(entry) for key, entry in pages.items()):
+            return pages
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return {}
+
+def save_page_cache(pages):
+    """Persist cached group pages for the next run."""
+    try:
+        os.makedirs(os.path.dirname(PAGE_CACHE_PATH), mode=0o700, exist_ok=True)
+        with open(PAGE_CACHE_PATH, 'wb') as f:
+            f.write(orjson.dumps({'org_id': ADOBE_ORG_ID, 'pages': pages}))
+    except OSError as e:
+        print(f"Could not cache group pages: {e}")
+
+def get_groups_page(page_index, headers, page_cache):
+    """Retrieve a page of groups, revalidating any cached copy with the server.
 
-    headers = {
+    Returns (page, status_code, error); page is None on failure and
+    status_code is None when no response was received.
+    """
+    key = str(page_index)
+    cached = page_cache.get(key)
+    if cached:
+        headers = dict(headers)
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    try:
+        response = SESSION.get(GROUPS_URL + key, headers=headers, timeout=120)
+    except requests.exceptions.RequestException as e:
+        return None, None, f"Exception during API call: {e}"
+
+    if response.status_code == 304 and cached:
+        return cached['page'], response.status_code, None
+    if response.status_code == 200:
+        data = orjson.loads(response.content)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            page_cache[key] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'page': {
+                    'lastPage': data['lastPage'],
+                    'groups': [
+                        {
+                            'groupName': group['groupName'],
+                            'type': group.get('type'),
+                            'memberCount': group.get('memberCount', 0)
+                        }
+                        for group in data['groups']
+                    ]
+                }
+            }
+        else:
+            page_cache.pop(key, None)
+        return data, response.status_code, None
+    return None, response.status_code, f"Failed to retrieve group data: {response.status_code} - {response.text}"
+
+def get_auth_headers(access_token):
+    """Build the Adobe API headers for the given access token."""
+    return {
         'Accept': 'application/json',
-        'x-api-key': os.getenv('ADOBE_CLIENT_ID'),
+        'x-api-key': ADOBE_CLIENT_ID,
         'Authorization': f"Bearer {access_token}"
     }
 
-    while True:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            users_list.extend(data['users'])
-            if data['lastPage']:
-                break
-            page_index += 1
-            url = f"{USER_API_BASE_URL}/{os.getenv('ADOBE_ORG_ID')}/{page_index}"
-        else:
-            print(f"Failed to retrieve user data: {response.status_code} - {response.text}")
-            break
-
-    return users_list
-
-def summarize_licenses(users):
-    """Summarize licenses associated with users."""
-    license_counts = {}
-
-    for user in users:
-        for group in user.get('groups', []):
-            if group in EXCLUDED_GROUPS:
-                continue  # Skip excluded groups
-
-            cleaned_group = (
-                group.replace("Default ", "")
-                .replace("configuration", "")
-                .replace(" plan with 1TB", "")
-                .replace(" - 100 GB", "")
-                .replace(" - 1024 GB", "")
-                .replace("Single App", "")
-                .replace(" DC", "")
-                .replace(" 3D Collection Configuration", "")
-                .strip()
-            )
-            license_counts[cleaned_group] = license_counts.get(cleaned_group, 0) + 1
+def count_licenses_in_org(access_token, license_counts, token_from_cache=False):
+    """Count licenses across all group pages of the Adobe organization into license_counts."""
+    headers = get_auth_headers(access_token)
+    page_cache = load_page_cache()
+
+    data, status_code, error = get_groups_page(0, headers, page_cache)
+    if status_code == 401 and token_from_cache:
+        # The cached token was revoked before it expired; replace it and
+        # retry once so this run still produces a report
+        print("Cached access token was rejected. Generating a new one...")
+        clear_cached_token()
+        access_token = fetch_access_token()
+        if not access_token:
+            return
+        headers = get_auth_headers(access_token)
+        data, status_code, error = get_groups_page(0, headers, page_cache)
+    if data is None:
+        print(error)
+        return
+    count_group_licenses(license_counts, data['groups'])
+    done = data['lastPage']
+    last_page = 0
 
-    summary = []
-    for license_name, used in license_counts.items():
-        total = LICENSE_MAPPING.get(license_name, "Unknown")
-        unit = "License" if license_name != "Adobe Stock Credits" else "Credits"
-        unit += "s" if used > 1 else ""
-        summary.append(f"{license_name}: {used} of {total} {unit}")
+    # Keep a sliding window of in-flight page requests so a slow page never
+    # stalls the pages behind it. The window grows by one page per page
+    # consumed, so at most MAX_WORKERS - 1 requests go past the last page.
+    pending = deque()
+    next_page = 1
+    window = 1
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        try:
+            while not done:
+                while len(pending) < window:
+                    pending.append(executor.submit(get_groups_page, next_page, headers, page_cache))
+                    next_page += 1
+                data, _, error = pending.popleft().result()
+                if data is None:
+                    print(error)
+                    break
+                last_page += 1
+                count_group_licenses(license_counts, data['groups'])
+                done = data['lastPage']
+                window = min(window + 1, MAX_WORKERS)
+        finally:
+            # Drop speculative requests for pages past the last one
+            for future in pending:
+                future.cancel()
 
-    return "\n".join(summary)
+    # Only a complete walk is cached, without any pages past the last one
+    if done:
+        save_page_cache({key: page for key, page in page_cache.items() if int(key) <= last_page})
+
+@lru_cache(maxsize=256)
+def clean_license_name(group: str) -> Optional[str]:
+    """Strip configuration/storage fragments from a group name; None if excluded."""
+    if LICENSE_EXCLUDE_RE.search(group):
+        return None
+    return LICENSE_CLEANUP_RE.sub("", group).strip()
+
+def count_group_licenses(license_counts: Counter, groups: list[dict]) -> None:
+    """Add the member count of each product profile in groups to license_counts."""
+    for group in groups:
+        if group.get('type') != 'PRODUCT_PROFILE':
+            continue
+        license_name = clean_license_name(group['groupName'])
+        # Excluded groups clean to None and are skipped
+        if license_name and group.get('memberCount'):
+            license_counts[license_name] += group['memberCount']
+
+def summarize_licenses(license_counts: Counter) -> str:
+    """Summarize license usage from the collected counts."""
+    return "\n".join(
+        f"{license_name}: {used} of {LICENSE_MAPPING.get(license_name, 'Unknown')} "
+        f"{LICENSE_UNITS.get(license_name, 'License')}{'s' if used > 1 else ''}"
+        for license_name, used in license_counts.items()
+    )
 
 def send_slack_alert(message):
     """Send the license summary to Slack."""
-    webhook_url = os.getenv('SLACK_WEBHOOK_URL')
     payload = {"text": message}
-    response = requests.post(webhook_url, json=payload)
+    response = SESSION.post(SLACK_WEBHOOK_URL, json=payload)
     if response.status_code == 200:
         print("Slack alert sent!")
     else:
         print(f"Failed to send Slack alert: {response.status_code} - {response.text}")
 
 if __name__ == '__main__':
-    # Generate a new token
-    token = get_access_token()
+    # Reuse a cached token or generate a new one
+    token, token_from_cache = get_access_token()
 
     if token:
-        # Fetch users
-        users = get_users_in_org(token)
+        # Fetch groups, counting licenses as pages arrive
+        license_counts = Counter()
+        count_licenses_in_org(token, license_counts, token_from_cache)
 
-        if users:
+        if license_counts:
             # Summarize licenses
-            summary = summarize_licenses(users)
-            print("License Summary:\n" + summary)
+            summary = summarize_licenses(license_counts)
 
-            # Send Slack alert
-            send_slack_alert(f":adobe: *Adobe License Report* :adobe:\n{summary}")
+            # Send Slack alert in the background while the summary is logged
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                slack_alert = executor.submit(send_slack_alert, f":adobe: *Adobe License Report* :adobe:\n{summary}")
+                print("License Summary:\n" + summary)
+                slack_alert.result()
         else:
-            print("No user data retrieved.")
+            print("No license data retrieved.")
     else:
         print("Failed to retrieve access token.")